@@ -7,39 +7,81 @@ from __future__ import annotations
 import os
 import json
 import asyncio
-from contextlib import suppress
 from io import BytesIO
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Iterator, Optional
 import base64
+import functools
+import hashlib
+from html import escape as html_escape
+from html.parser import HTMLParser
+import threading
+import shelve
+import itertools
 
 import streamlit as st
-import streamlit.components.v1 as components
-import markdown
-from xhtml2pdf import pisa
-
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+# markdown / xhtml2pdf / reportlab / weasyprint は重いので、使う関数の中で import する
+if TYPE_CHECKING:  # 型注釈のためだけの import（実行時には読み込まない）
+    import markdown
+    from reportlab.lib.styles import ParagraphStyle
+
+# ─────────── orjson (任意) ───────────
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None  # 未インストールなら標準の json で代用
+
+# ─────────── ijson (任意) ───────────
+try:
+    import ijson
+except ModuleNotFoundError:
+    ijson = None  # 未インストールならファイル全体を読み込んでパース
+
+import gc
 import sys
+import time
+import atexit
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 
 # ──── Azure AppService 向けログ設定 ────
-# ログをすべて stdout に流す  
+# ログをすべて stdout に流す。stdout への書き込みはバックグラウンドの
+# QueueListener に任せ、呼び出し側はキューに積むだけにする（出力詰まりで処理を止めない）
 root_logger = logging.getLogger()  
 root_logger.setLevel(logging.INFO)
 
-# 既存ハンドラをクリア（重複防止のため）  
-for h in list(root_logger.handlers):
-    root_logger.removeHandler(h)
-
-# stdout 用ハンドラ  
-sh = logging.StreamHandler(sys.stdout)
-sh.setLevel(logging.INFO)
-sh.setFormatter(
-    logging.Formatter("%(message)s")
-)
-root_logger.addHandler(sh)
+# Streamlit は再実行のたびにこのスクリプトを実行するので、設定はプロセスで一度だけ
+if not any(isinstance(h, QueueHandler) for h in root_logger.handlers):
+    # 既存ハンドラをクリア（重複防止のため）  
+    for h in list(root_logger.handlers):
+        root_logger.removeHandler(h)
+
+    # stdout 用ハンドラ  
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(
+        logging.Formatter("%(message)s")
+    )
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, sh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root_logger.addHandler(QueueHandler(log_queue))
 
 logger = logging.getLogger(__name__)
 
+# learnings の表示をまとめる間隔（秒）
+LEARNINGS_FLUSH_INTERVAL = 0.25
+# 生成中のレポートを再描画する間隔（秒）
+REPORT_PREVIEW_INTERVAL = 0.5
+
+# ─────────── GC 設定 ───────────
+# 再実行のたびに大量の一時オブジェクトが生まれるが、処理の大半は I/O 待ちなので
+# 世代 0 の閾値を上げて循環 GC の走査回数を減らす
+gc.set_threshold(50_000, 10, 10)
+
 # ─────────── Page Configuration ───────────
 # Must be first Streamlit call
 st.set_page_config(page_title="Deep Research Prototype", layout="wide")
@@ -64,11 +106,11 @@ if WANDB_ENABLE_WEAVE:
 # ─────────── Deep Research Imports ───────────
 from deep_research import (
     deep_research,
-    write_final_report,
+    write_final_report_stream,
     write_final_answer,
     ResearchProgress,
     ResearchResult,
-    generate_followup_sync, # sync version
+    generate_followup,
     # judge_followup_required,
     # followup_research,
 )
@@ -78,6 +120,8 @@ if "selected_history" not in st.session_state:
     st.session_state.selected_history: Optional[int] = None
 if "last_report" not in st.session_state:
     st.session_state.last_report: Optional[str] = None
+if "last_report_html" not in st.session_state:
+    st.session_state.last_report_html: Optional[str] = None
 if "last_output_type" not in st.session_state:
     st.session_state.last_output_type: Optional[str] = None
 if "pending_query" not in st.session_state:
@@ -90,24 +134,442 @@ if "show_readme" not in st.session_state:
     st.session_state["show_readme"] = False
 
 
+# ─────────── Utility: 履歴の重複判定 ───────────
+# 履歴エントリの "_" で始まるキーは表示用の派生データ（キャッシュ）で、
+# 重複判定やファイル保存の対象にはしない
+def _public_fields(entry: Any) -> Any:
+    if not isinstance(entry, dict):
+        return entry
+    return {k: v for k, v in entry.items() if not k.startswith("_")}
+
+
+def _json_dumps(obj: Any, *, sort_keys: bool = False) -> bytes:
+    """コンパクトな UTF-8 JSON を返す（orjson が無ければ標準の json）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(
+        obj, ensure_ascii=False, sort_keys=sort_keys, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+
+def _open_history_file(uploaded) -> Optional[Iterator[Any]]:
+    """アップロードされた履歴ファイルのエントリを 1 件ずつ返すイテレータを作る
+
+    ijson があればストリーミングでパースする（ファイル全体を一度に読み込まない）。
+    トップレベルがリストでなければ None を返す。
+    """
+    if ijson is None:
+        data = uploaded.getvalue()
+        loaded = _json_loads(data[len(_UTF8_BOM):] if data.startswith(_UTF8_BOM) else data)
+        return iter(loaded) if isinstance(loaded, list) else None
+    head = uploaded.read(1024)
+    start = len(_UTF8_BOM) if head.startswith(_UTF8_BOM) else 0  # BOM 付き UTF-8 も受け付ける
+    if not head[start:].lstrip().startswith(b"["):
+        return None
+    uploaded.seek(start)
+    return ijson.items(uploaded, "item", use_float=True)
+
+
+def _history_key(entry: Any) -> str:
+    """履歴エントリの正規化 JSON から重複判定用のハッシュを作る"""
+    payload = _json_dumps(_public_fields(entry), sort_keys=True)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def _report_html(entry: dict) -> str:
+    """レポートの HTML を一度だけ変換してエントリに保持する"""
+    html = entry.get("_report_html")
+    if html is None:
+        html = entry["_report_html"] = md_to_html(entry["report"])
+    return html
+
+
+def _set_last_report(entry: Optional[dict]) -> None:
+    """直近の調査結果と、その表示用 HTML をまとめて更新する"""
+    st.session_state.last_report = entry["report"] if entry else None
+    st.session_state.last_report_html = _report_html(entry) if entry else None
+
+
+def _history_title(query: str) -> str:
+    return query[:20] + ('...' if len(query) > 20 else '')
+
+
+# ─────────── 履歴の永続化（任意） ───────────
+# HISTORY_DB_PATH を指定すると、履歴を shelve に保存してリロード後も復元する。
+# ストアはプロセス内の全セッションで共有されるため、1 ユーザーで使う環境向け。
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "")
+
+
+@st.cache_resource
+def _history_seq() -> itertools.count:
+    """同じ時刻に追加されたエントリのキーを区別する連番（プロセスで 1 つ）"""
+    return itertools.count()
+
+
+@st.cache_resource
+def _history_store() -> Optional[tuple[shelve.Shelf, threading.Lock]]:
+    if not HISTORY_DB_PATH:
+        return None
+    shelf = shelve.open(HISTORY_DB_PATH, writeback=False)
+    atexit.register(shelf.close)
+    return shelf, threading.Lock()
+
+
+def _load_stored_history() -> list[dict]:
+    """保存済みの履歴を追加順に読み出す（セッション開始時に 1 回だけ）"""
+    store = _history_store()
+    if store is None:
+        return []
+    shelf, lock = store
+    with lock:
+        return [shelf[k] for k in sorted(shelf.keys())]
+
+
+def _store_history(entry: dict) -> None:
+    store = _history_store()
+    if store is None:
+        return
+    shelf, lock = store
+    # HTML は再変換できるので保存しない。キーは追加時刻（ns）にして並び順を保ち、
+    # 時計の分解能が粗くても同じキーで上書きしないよう連番を付ける
+    record = {k: v for k, v in entry.items() if k != "_report_html"}
+    with lock:
+        shelf[f"{time.time_ns():020d}-{next(_history_seq()):010d}"] = record
+        shelf.sync()
+
+
+def _clear_stored_history() -> None:
+    store = _history_store()
+    if store is None:
+        return
+    shelf, lock = store
+    with lock:
+        shelf.clear()
+        shelf.sync()
+
+
+def _history_hashes() -> set[str]:
+    """重複判定用のハッシュ集合。初めて履歴を読み込むときにだけ作る"""
+    hashes = st.session_state.history_hashes
+    if hashes is None:
+        history = st.session_state.history
+        hashes = st.session_state.history_hashes = {_history_key(e) for e in history} if history else set()
+    return hashes
+
+
+def _append_history(entry: dict, key: Optional[str] = None) -> None:
+    if "_title" not in entry:
+        entry["_title"] = _history_title(entry['query'])  # サイドバー表示用に追加時に一度だけ作る
+    st.session_state.history.append(entry)
+    _store_history(entry)
+    if st.session_state.history_hashes is not None:
+        st.session_state.history_hashes.add(key or _history_key(entry))
+
+
+def _history_json(history: tuple[dict, ...]) -> bytes:
+    """履歴をダウンロード用 JSON にする（ボタン押下時にだけ呼ばれる）
+
+    ScriptRunContext の無い別スレッドで呼ばれ、st.session_state を読めないため、
+    履歴は描画時に渡しておく。
+    """
+    return _json_dumps([_public_fields(e) for e in history])
+
+
+if "history_hashes" not in st.session_state:
+    st.session_state.history_hashes: Optional[set[str]] = None  # _history_hashes() で遅延生成
+if "history_loaded" not in st.session_state:
+    st.session_state.history.extend(_load_stored_history())
+    st.session_state.history_loaded = True
+
+
 # ─────────── Utility: Create PDF from Markdown using external CSS ───────────
-def create_pdf_from_md(md_text: str) -> BytesIO:
-    html_body = markdown.markdown(md_text, extensions=["extra"])
+@st.cache_resource
+def _pdf_template() -> tuple[str, str]:
+    """pdf_style.css を一度だけ読み込み、HTML の前半／後半を組み立てて返す。"""
     css_path = os.path.join(os.path.dirname(__file__), "pdf_style.css")
     with open(css_path, encoding="utf-8") as f:
         css_content = f.read()
     style = f"<style>{css_content}</style>"
-    html = f"<html><head><meta charset='utf-8'>{style}</head><body>{html_body}</body></html>"
+    return f"<html><head><meta charset='utf-8'>{style}</head><body>", "</body></html>"
+
+
+@st.cache_resource
+def _markdown_parser() -> tuple[markdown.Markdown, threading.Lock]:
+    """Markdown パーサを使い回す（インスタンスはスレッドセーフでないのでロック付き）。"""
+    import markdown
+
+    return markdown.Markdown(extensions=["extra"], output_format="html5"), threading.Lock()
+
+
+def md_to_html(md_text: str) -> str:
+    md, lock = _markdown_parser()
+    with lock:
+        return md.reset().convert(md_text)
+
+
+# xhtml2pdf は長い表・長文でレイアウトが O(n²) になるため、WeasyPrint / ReportLab を選択可能にする
+PDF_BACKEND = os.getenv("PDF_BACKEND", "xhtml2pdf").lower()
+
+
+def _to_pdf_pisa(html: str) -> BytesIO:
+    from xhtml2pdf import pisa
+
     buffer = BytesIO()
     pisa.CreatePDF(src=html, dest=buffer)
     buffer.seek(0)
     return buffer
 
+
+def _to_pdf_weasy(html: str) -> Optional[BytesIO]:
+    """WeasyPrint で PDF 化する。未インストール（または GTK/Pango 不足）なら None"""
+    try:
+        from weasyprint import HTML
+    except (ImportError, OSError):
+        return None
+    base_url = os.path.dirname(os.path.abspath(__file__))  # フォントの相対パス解決用
+    return BytesIO(HTML(string=html, base_url=base_url).write_pdf())
+
+
+# ─────────── ReportLab で直接組版（表を含まない単純なレポート向け） ───────────
+@st.cache_resource
+def _reportlab_styles() -> dict[str, ParagraphStyle]:
+    """NotoSansJP の登録とスタイル生成を一度だけ行う"""
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.pdfmetrics import registerFontFamily
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    # キャッシュがクリアされても（ホットリロード等）TTF を再パースしないよう、プロセスで一度だけ登録
+    if "NotoSansJP" not in pdfmetrics.getRegisteredFontNames():
+        font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NotoSansJP-Regular.ttf")
+        pdfmetrics.registerFont(TTFont("NotoSansJP", font_path))
+        # 太字・斜体も同じフォントに割り当てる（<b>/<i> でフォント未登録エラーにしない）
+        registerFontFamily("NotoSansJP", normal="NotoSansJP", bold="NotoSansJP",
+                           italic="NotoSansJP", boldItalic="NotoSansJP")
+    # wordWrap="CJK" で日本語も行の途中で折り返す
+    body = ParagraphStyle("body", fontName="NotoSansJP", fontSize=10, leading=15,
+                          spaceAfter=6, wordWrap="CJK")
+    return {
+        "p": body,
+        "li": ParagraphStyle("li", parent=body, spaceAfter=2),
+        "pre": ParagraphStyle("pre", parent=body, fontSize=9, leading=12, backColor="#f5f5f5"),
+        "blockquote": ParagraphStyle("blockquote", parent=body, leftIndent=12, textColor="#555555"),
+        "h1": ParagraphStyle("h1", parent=body, fontSize=18, leading=24, spaceBefore=12, spaceAfter=8),
+        "h2": ParagraphStyle("h2", parent=body, fontSize=15, leading=20, spaceBefore=10, spaceAfter=6),
+        "h3": ParagraphStyle("h3", parent=body, fontSize=13, leading=18, spaceBefore=8, spaceAfter=4),
+        "h4": ParagraphStyle("h4", parent=body, fontSize=11, leading=16, spaceBefore=6, spaceAfter=4),
+    }
+
+
+class _FlowableBuilder(HTMLParser):
+    """Markdown から生成した HTML を ReportLab の Flowable 列に変換する簡易パーサ"""
+
+    _BLOCKS = {"p", "li", "pre", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6"}
+    _INLINE = {"b": "b", "strong": "b", "i": "i", "em": "i", "u": "u", "sup": "super", "sub": "sub"}
+    _EXTERNAL_SCHEMES = ("http://", "https://", "mailto:")
+
+    def __init__(self, styles: dict[str, ParagraphStyle]):
+        super().__init__(convert_charrefs=True)
+        self.styles = styles
+        self.flowables: list = []
+        self._buf: list[str] = []
+        self._block: Optional[str] = None
+        self._lists: list[list] = []  # [タグ名, 連番] のスタック
+        self._links: list[bool] = []  # <a> ごとに、リンクとして出力したかどうか
+
+    def _flush(self) -> None:
+        from reportlab.lib.styles import ParagraphStyle
+        from reportlab.platypus import Paragraph
+
+        text = "".join(self._buf).strip()
+        self._buf.clear()
+        if not text or self._block is None:
+            return
+        style_key = "h4" if self._block in ("h5", "h6") else self._block
+        style = self.styles.get(style_key, self.styles["p"])
+        if self._block == "li" and self._lists:
+            kind = self._lists[-1]
+            kind[1] += 1
+            bullet = f"{kind[1]}." if kind[0] == "ol" else "•"
+            indent = 14 * len(self._lists)
+            style = ParagraphStyle(f"li{len(self._lists)}", parent=style, leftIndent=indent, bulletIndent=indent - 10)
+            self.flowables.append(Paragraph(text, style, bulletText=bullet))
+        else:
+            self.flowables.append(Paragraph(text, style))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("ul", "ol"):
+            self._flush()
+            self._lists.append([tag, 0])
+        elif tag in self._BLOCKS:
+            if tag == "p" and self._block == "li":
+                return  # リスト項目内の段落は項目の一部として扱う
+            self._flush()
+            self._block = tag
+        elif tag in self._INLINE:
+            self._buf.append(f"<{self._INLINE[tag]}>")
+        elif tag == "code":
+            self._buf.append("<font face='Courier'>")
+        elif tag == "a":
+            # 文書内アンカー（脚注 #fn:1 など）は飛び先が無く ReportLab がエラーにするので、外部リンクだけ残す
+            href = dict(attrs).get("href") or ""
+            is_link = href.startswith(self._EXTERNAL_SCHEMES)
+            if is_link:
+                self._buf.append(f"<a href='{html_escape(href)}' color='blue'>")
+            self._links.append(is_link)
+        elif tag == "br":
+            self._buf.append("<br/>")
+        elif tag == "hr":
+            from reportlab.platypus import HRFlowable
+
+            self._flush()
+            self.flowables.append(HRFlowable(width="100%", thickness=0.5, color="#999999"))
+
+    def handle_endtag(self, tag):
+        if tag in ("ul", "ol"):
+            self._flush()
+            if self._lists:
+                self._lists.pop()
+            self._block = "li" if self._lists else None
+        elif tag in self._BLOCKS:
+            if tag == "p" and self._block == "li":
+                return
+            self._flush()
+            self._block = "li" if self._lists else None
+        elif tag in self._INLINE:
+            self._buf.append(f"</{self._INLINE[tag]}>")
+        elif tag == "code":
+            self._buf.append("</font>")
+        elif tag == "a":
+            if self._links and self._links.pop():
+                self._buf.append("</a>")
+
+    def close(self) -> None:
+        super().close()
+        self._flush()
+
+    def handle_data(self, data):
+        if self._block is None:
+            if not data.strip():
+                return
+            self._block = "p"
+        text = html_escape(data, quote=False)
+        if self._block == "pre":
+            text = text.replace("\n", "<br/>")
+        self._buf.append(text)
+
+
+def _to_pdf_reportlab(html_body: str) -> BytesIO:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate
+
+    builder = _FlowableBuilder(_reportlab_styles())
+    builder.feed(html_body)
+    builder.close()
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=40, rightMargin=40, topMargin=40, bottomMargin=40)
+    doc.build(builder.flowables)
+    buffer.seek(0)
+    return buffer
+
+
+def create_pdf_from_md(md_text: str) -> BytesIO:
+    html_body = md_to_html(md_text)
+    # 表は簡易パーサでは組版できないため、その場合だけ HTML→PDF エンジンに回す
+    if PDF_BACKEND == "reportlab" and "<table" not in html_body:
+        return _to_pdf_reportlab(html_body)
+    html_prefix, html_suffix = _pdf_template()
+    html = f"{html_prefix}{html_body}{html_suffix}"
+    if PDF_BACKEND == "weasyprint":
+        pdf = _to_pdf_weasy(html)
+        if pdf is not None:
+            return pdf
+        logger.warning("PDF_BACKEND=weasyprint ですが WeasyPrint が利用できないため xhtml2pdf を使用します")
+    return _to_pdf_pisa(html)
+
+
+@st.cache_data(show_spinner=False)
+def _cached_pdf(md_text: str) -> bytes:
+    """レポート本文をキーに PDF をキャッシュ（再描画のたびに再生成しない）"""
+    return create_pdf_from_md(md_text).getvalue()
+
+# ─────────── Utility: README 用チャート ───────────
+@st.cache_resource
+def _chart_data_uri(chart_path: str) -> str:
+    """chart.svg を一度だけ読み込み、data URI にして使い回す"""
+    with open(chart_path, "rb") as f:
+        b64 = base64.b64encode(f.read()).decode("utf-8")
+    return f"data:image/svg+xml;base64,{b64}"
+
+# ─────────── Utility: フォローアップ質問のキャッシュ ───────────
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_followup(query: str) -> list[str]:
+    """同じ質問の再送信では LLM を呼ばずに前回の結果を返す"""
+    # 非同期クライアントの接続プールを共有するため、永続ループ上で実行する
+    return _run_async(generate_followup(query))
+
+# ─────────── Utility: 永続イベントループ ───────────
+# 呼び出しごとにループを作り直すと、非同期クライアントの接続プールや TLS セッションが
+# 毎回捨てられてしまうため、プロセス共通のループをバックグラウンドスレッドで回し続ける
+# true にすると Linux で uringcore（io_uring）のループを試す（カーネルやコンテナの制限で使えないことがあるため任意）
+USE_URINGCORE = os.getenv("USE_URINGCORE", "false").lower() == "true"
+
+
+def _new_event_loop() -> asyncio.AbstractEventLoop:
+    """利用できる中で最速のイベントループを作る
+
+    USE_URINGCORE=true なら uringcore（io_uring）を試し、次に uvloop を使い、
+    どちらも無ければ標準の asyncio にフォールバックする。
+    """
+    if USE_URINGCORE and sys.platform.startswith("linux"):
+        try:
+            import uringcore
+
+            return uringcore.EventLoopPolicy().new_event_loop()
+        except Exception as e:  # 未インストール、io_uring 非対応のカーネル、seccomp での禁止など
+            logger.warning("uringcore event loop unavailable, falling back: %r", e)
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+@st.cache_resource
+def _get_loop() -> asyncio.AbstractEventLoop:
+    loop = _new_event_loop()
+    threading.Thread(target=loop.run_forever, name="research-loop", daemon=True).start()
+    return loop
+
+
+def _run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def _with_script_ctx(fn):
+    """ループ側のスレッドから Streamlit 要素を更新できるよう、呼び出し元の ScriptRunContext を付ける"""
+    ctx = get_script_run_ctx()
+
+    def _wrapped(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+
+    return _wrapped
+
 # ─────────── Sidebar: New Research & Settings ───────────
 st.sidebar.header("Deep Researchメニュー")
 if st.sidebar.button("🔍 新規調査開始", key="new_research"):
     st.session_state.selected_history = None
-    st.session_state.last_report = None
+    _set_last_report(None)
     st.session_state.last_output_type = None
     st.session_state.show_readme = False
 
@@ -123,30 +585,33 @@ with st.sidebar.expander("⚙️ 設定オプション", expanded=True):
 
 # ─────────── Sidebar: 履歴メニュー ───────────
 with st.sidebar.expander("📂 履歴メニュー", expanded=False):
-    history_json = json.dumps(st.session_state.history, ensure_ascii=False, indent=2)
     st.download_button(
         label="履歴をファイルに保存する",
-        data=history_json,
+        data=functools.partial(_history_json, tuple(st.session_state.history)),
         file_name="history.json",
         mime="application/json",
     )
-    # 履歴を読み込む
-    uploaded = st.file_uploader(
-        label="履歴を読み込む",
-        type=["json"],
-        key="upload_history",
-        accept_multiple_files=False,
-    )
-    if uploaded:
+    # 履歴を読み込む（フォームにして、読み込みボタン押下時の 1 回だけ処理する）
+    with st.form("upload_history_form", clear_on_submit=True, border=False):
+        uploaded = st.file_uploader(
+            label="履歴を読み込む",
+            type=["json"],
+            key="upload_history",
+            accept_multiple_files=False,
+        )
+        submitted_upload = st.form_submit_button("読み込む")
+    if submitted_upload and uploaded:
         try:
-            loaded = json.load(uploaded)
-            if isinstance(loaded, list):
-                existing = set(json.dumps(e, ensure_ascii=False) for e in st.session_state.history)
+            entries = _open_history_file(uploaded)
+            if entries is not None:
+                # 途中でパースに失敗したときに一部だけ取り込まれないよう、全件読み終えてから追加する
+                parsed = list(entries)
                 count_added = 0
-                for entry in loaded:
-                    entry_str = json.dumps(entry, ensure_ascii=False)
-                    if entry_str not in existing:
-                        st.session_state.history.append(entry)
+                hashes = _history_hashes()
+                for entry in parsed:
+                    key = _history_key(entry)
+                    if key not in hashes:
+                        _append_history(entry, key)
                         count_added += 1
                 st.success(f"{count_added} 件の履歴を読み込みました！")
             else:
@@ -156,6 +621,8 @@ with st.sidebar.expander("📂 履歴メニュー", expanded=False):
     # クリア
     if st.button("履歴をクリア", key="clear_history"):
         st.session_state.history.clear()
+        _clear_stored_history()
+        st.session_state.history_hashes = None
         st.success("履歴をクリアしました！")
         st.rerun()
 
@@ -171,12 +638,17 @@ with st.sidebar:
 st.sidebar.markdown("---")
 # ─────────── Sidebar: 調査履歴 ───────────
 st.sidebar.header("調査履歴")
+HISTORY_SIDEBAR_LIMIT = 20  # サイドバーに並べるボタン数の上限（新しいものから）
 if st.session_state.history:
-    for idx, entry in enumerate(st.session_state.history):
-        title = entry['query'][:20] + ('...' if len(entry['query']) > 20 else '')
-        if st.sidebar.button(title, key=f"hist_{idx}"):
+    history = st.session_state.history
+    show_all = len(history) <= HISTORY_SIDEBAR_LIMIT or st.sidebar.toggle(
+        f"もっと見る（全 {len(history)} 件）", key="show_all_history"
+    )
+    start = 0 if show_all else len(history) - HISTORY_SIDEBAR_LIMIT
+    for idx in range(start, len(history)):
+        if st.sidebar.button(history[idx]['_title'], key=f"hist_{idx}"):
             st.session_state.selected_history = idx
-            st.session_state.last_report = None
+            _set_last_report(None)
             st.session_state.last_output_type = None
 else:
     st.sidebar.write("(履歴なし)")
@@ -203,18 +675,11 @@ if st.session_state.get("show_readme", False):
 * 深さが進むごとに幅は半減（4→2→1）します。
     """)
     # ここで chart.svg を表示
-    def render_svg(svg_text: str) -> None:
-        """Renders the given svg string."""
-        b64 = base64.b64encode(svg_text.encode('utf-8')).decode("utf-8")
-        html = f'<img src="data:image/svg+xml;base64,{b64}"/>'
-        st.write(html, unsafe_allow_html=True)
-
     chart_path = os.path.join(os.path.dirname(__file__), "chart.svg")
     if os.path.exists(chart_path):
         try:
-            with open(chart_path, "r", encoding="utf-8") as f:
-                svg_text = f.read()
-            render_svg(svg_text)
+            chart_uri = _chart_data_uri(chart_path)
+            st.write(f'<img src="{chart_uri}"/>', unsafe_allow_html=True)
         except Exception:
             st.warning("chart.svg の読み込みに失敗しました。")
     else:
@@ -228,6 +693,25 @@ if st.session_state.get("show_readme", False):
 
 
 
+# ─────────── レポート表示（履歴・直近の結果で共通） ───────────
+def _render_report(report_html: str, report: str, key_prefix: str) -> None:
+    st.html(report_html)
+    col1, col2 = st.columns(2)
+    with col1:
+        # 本文を iframe に二重に埋め込まないよう、コピー用テキストは要求されたときだけ出す
+        show_copy = st.toggle("📋 レポートをコピー", key=f"{key_prefix}_copy")
+    with col2:
+        st.download_button(
+            "PDFで保存",
+            data=functools.partial(_cached_pdf, report),  # クリック時にだけ生成
+            file_name="history_report.pdf",
+            mime="application/pdf",
+            key=f"{key_prefix}_pdf",
+        )
+    if show_copy:
+        st.code(report, language="markdown", wrap_lines=True)  # 右上のアイコンでコピー
+
+
 # ─────────── Main Page ───────────
 st.title("🔍 Deep Research prototype")
 st.markdown("OpenAI o3を使って、幅／深さをコントロールしながらウェブリサーチを行います。")
@@ -237,53 +721,12 @@ if st.session_state.selected_history is not None and 0 <= st.session_state.selec
     st.subheader("📂 過去の調査結果")
     st.markdown(f"**調査依頼**: {entry['followups']}")
     with st.expander("📚 調査で得たLearnings", expanded=False):
-        for l in entry['learnings']:
-            st.markdown(f"- {l}")
+        st.markdown("\n".join(f"- {l}" for l in entry['learnings']))
     st.markdown("**最終レポート**:")
-    st.markdown(entry['report'], unsafe_allow_html=True)
-    col1, col2 = st.columns(2)
-    with col1:
-        components.html(
-            f"""
-            <textarea id='history-report-text' style='opacity:0;position:absolute;left:-9999px;'>{entry['report']}</textarea>
-            <button onclick="(function(){{ var el=document.getElementById('history-report-text'); el.style.display='block'; el.select(); document.execCommand('copy'); el.style.display='none'; alert('レポートをコピーしました'); }})();">レポートをコピー</button>
-            """,
-            height=80,
-        )
-    with col2:
-        pdf_buffer = create_pdf_from_md(entry['report'])
-        b64 = base64.b64encode(pdf_buffer.getvalue()).decode()
-        st.markdown(
-            f"""
-            <a href="data:application/pdf;base64,{b64}" download="history_report.pdf">
-                <button class="copy-button">PDFで保存</button>
-            </a>
-            """,
-            unsafe_allow_html=True
-        )
+    _render_report(_report_html(entry), entry['report'], "history")
 elif st.session_state.last_report is not None:
     st.subheader("📄 Final Report")
-    st.markdown(st.session_state.last_report, unsafe_allow_html=True)
-    col1, col2 = st.columns(2)
-    with col1:
-        components.html(
-            f"""
-            <textarea id='report-text' style='opacity:0;position:absolute;left:-9999px;'>{st.session_state.last_report}</textarea>
-            <button onclick="(function(){{ var el=document.getElementById('report-text'); el.style.display='block'; el.select(); document.execCommand('copy'); el.style.display='none'; alert('レポートをコピーしました'); }})();">レポートをコピー</button>
-            """,
-            height=80,
-        )
-    with col2:
-        pdf_buffer = create_pdf_from_md(st.session_state.last_report)
-        b64 = base64.b64encode(pdf_buffer.getvalue()).decode()
-        st.markdown(
-            f"""
-            <a href="data:application/pdf;base64,{b64}" download="history_report.pdf">
-                <button class="copy-button">PDFで保存</button>
-            </a>
-            """,
-            unsafe_allow_html=True
-        )
+    _render_report(st.session_state.last_report_html, st.session_state.last_report, "last_report")
 else:
     if "trigger_research" not in st.session_state:
         st.session_state.trigger_research = False
@@ -307,7 +750,7 @@ else:
         st.session_state.followup_answer = ""
         st.session_state.trigger_research = False
         with st.spinner("💭 フォローアップ質問を生成中です..."):
-            st.session_state.followup_questions = generate_followup_sync(query)
+            st.session_state.followup_questions = _cached_followup(query)
 
     if st.session_state.followup_questions:
         st.subheader("🧩 フォローアップ質問")
@@ -343,35 +786,36 @@ else:
             "depth": depth,
             "output": output_type
         }
-        logger.info(json.dumps(log_obj, ensure_ascii=False))
+        logger.info(_json_dumps(log_obj).decode("utf-8"))
 
         # query + followup answer を組み合わせ
-        base_query = st.session_state.pending_query
-        sections = [f"【ユーザーの質問】\n{base_query}"]
-
-        # フォローアップ質問の表示
-        if st.session_state.followup_questions:
-            followup_section = "\n".join(
-                f"{i+1}. {q}" for i, q in enumerate(st.session_state.followup_questions)
-            )
-            sections.append(f"【フォローアップ質問】\n{followup_section}")
-
-        # フォローアップ回答が空なら「なし」と明記
-        followup_answer = st.session_state.followup_answer.strip()
-        if followup_answer:
-            sections.append(f"【フォローアップ回答】\n{followup_answer}")
-        else:
-            sections.append("【フォローアップ回答】\nなし")
-
-        combined_query = "\n\n".join(sections)
+        # フォローアップ質問は存在する場合のみ載せ、回答が空なら「なし」と明記
+        followups = st.session_state.followup_questions
+        followup_section = (
+            "【フォローアップ質問】\n" + "\n".join(f"{i}. {q}" for i, q in enumerate(followups, 1)) + "\n\n"
+            if followups else ""
+        )
+        combined_query = (
+            f"【ユーザーの質問】\n{st.session_state.pending_query}\n\n"
+            f"{followup_section}"
+            f"【フォローアップ回答】\n{st.session_state.followup_answer.strip() or 'なし'}"
+        )
         
         st.info("調査実施中...")
         prog_bar_ph = st.progress(0.0)
         status_box_ph = st.empty()
         learn_expander = st.expander("📚 調査データ", expanded=False)
 
-        def _on_progress(p: ResearchProgress) -> None:
-            prog_bar_ph.progress(p.completed_queries / max(p.total_queries, 1))
+        # 前回描画した内容。変化が無ければプレースホルダを更新せず、ブラウザへの差分送信を省く
+        rendered: dict[str, Any] = {"ratio": None, "status": None, "flushed_at": 0.0}
+        learn_buf: list[str] = []
+
+        @_with_script_ctx
+        def _on_progress(p: ResearchProgress, new_learnings: tuple[str, ...]) -> None:
+            ratio = p.completed_queries / max(p.total_queries, 1)
+            if ratio != rendered["ratio"]:
+                prog_bar_ph.progress(ratio)
+                rendered["ratio"] = ratio
             lines = [
                 f"**Queries**: {p.completed_queries}/{p.total_queries}",
                 f"**Depth**  : {p.total_depth - p.current_depth}/{p.total_depth}",
@@ -379,24 +823,36 @@ else:
             ]
             if p.current_query:
                 lines.append(f"**Current query**: {p.current_query}")
-            status_box_ph.markdown("\n".join(lines))
-            if p.new_learnings:
-                learn_md = "\n".join(f"- {l}" for l in p.new_learnings)
-                learn_expander.markdown(learn_md)
-
-        def _run_async(coro):
-            with suppress(RuntimeError):
-                loop = asyncio.get_event_loop()
-                loop.close()
-            new_loop = asyncio.new_event_loop()
-            try:
-                return new_loop.run_until_complete(coro)
-            finally:
-                new_loop.close()
-
-        async def _driver() -> ResearchResult:
+            status = "\n".join(lines)
+            if status != rendered["status"]:
+                status_box_ph.markdown(status)
+                rendered["status"] = status
+            if new_learnings:
+                learn_buf.extend(new_learnings)
+                if time.monotonic() - rendered["flushed_at"] > LEARNINGS_FLUSH_INTERVAL:
+                    _flush_learnings()
+
+        def _flush_learnings() -> None:
+            # 短時間に届いた learnings はまとめて 1 要素として描画する
+            if learn_buf:
+                learn_expander.markdown("\n".join(f"- {l}" for l in learn_buf))
+                learn_buf.clear()
+            rendered["flushed_at"] = time.monotonic()
+
+        summary_ph = st.empty()
+
+        @_with_script_ctx
+        def _on_summarise_start() -> None:
+            _flush_learnings()  # 調査完了時点で残っている learnings を出し切る
+            summary_ph.info("📝 回答生成中です...")
+
+        @_with_script_ctx
+        def _on_report_delta(partial_md: str) -> None:
+            summary_ph.markdown(partial_md)
+
+        async def _pipeline() -> tuple[ResearchResult, str]:
             # ① まず通常のリサーチ
-            base_result = await deep_research(
+            research_result = await deep_research(
                 query=combined_query,
                 breadth=breadth,
                 depth=depth,
@@ -405,38 +861,44 @@ else:
 
             # ② 自動追加調査が ON なら breadth=2, depth=2 で再実行
             # if enable_followup:
-            #     return await followup_research(
+            #     research_result = await followup_research(
             #         query=combined_query,            # 元のクエリそのまま
-            #         learnings=base_result.learnings, # 既存 learnings を継承
-            #         visited_urls=base_result.visited_urls,
+            #         learnings=research_result.learnings, # 既存 learnings を継承
+            #         visited_urls=research_result.visited_urls,
             #         on_progress=_on_progress,        # 進捗バー再利用
             #     )
 
-            # 追加調査しない場合はそのまま返す
-            return base_result
-
-        
-        research_result = _run_async(_driver())
-
-        async def _summarise() -> str:
+            # ③ 同じループのまま最終レポート／回答を生成
+            _on_summarise_start()
             if output_type == "詳細レポート":
-                return await write_final_report(
+                # 生成中の本文を一定間隔で表示し、完成を待たずに読み始められるようにする
+                parts: list[str] = []
+                shown_at = time.monotonic()
+                async for delta in write_final_report_stream(
                     combined_query,
                     research_result.learnings,
                     research_result.visited_urls,
-                )
-            return await write_final_answer(combined_query, research_result.learnings)
-        
-        with st.spinner("📝 回答生成中です..."):
-            final_md = _run_async(_summarise())
-        st.session_state.last_report = final_md
-        st.session_state.last_output_type = output_type
-        st.session_state.history.append({
+                ):
+                    parts.append(delta)
+                    if time.monotonic() - shown_at > REPORT_PREVIEW_INTERVAL:
+                        _on_report_delta("".join(parts))
+                        shown_at = time.monotonic()
+                final_md = "".join(parts)
+            else:
+                final_md = await write_final_answer(combined_query, research_result.learnings)
+            return research_result, final_md
+
+        research_result, final_md = _run_async(_pipeline())
+        summary_ph.empty()
+        entry = {
             'query': query,
             'followups': combined_query,
             'learnings': research_result.learnings,
             'report': final_md,
-        })
+        }
+        _set_last_report(entry)
+        st.session_state.last_output_type = output_type
+        _append_history(entry)
 
         # セッションをクリア
         st.session_state.pending_query = None
@@ -1,19 +1,35 @@
 import os
+import asyncio
+import functools
+import operator
 from typing import Protocol, Dict, Any
 from types import SimpleNamespace
-from openai import OpenAI
 
-# ─────────── Firecrawl SDK ───────────
-try:
-    from firecrawl import FirecrawlApp as _FirecrawlSDK
-except ModuleNotFoundError:
-    _FirecrawlSDK = None  # Firecrawl 未インストール環境でも OK
+import httpx
 
-# ─────────── Tavily SDK ───────────
-try:
-    from tavily import TavilyClient as _TavilySDK
-except ModuleNotFoundError:
-    _TavilySDK = None     # 同様に未インストールでも OK
+from openai_client import HTTP2_AVAILABLE, get_openai_client
+
+# 1 クローラあたりの同時検索数の上限（レート制限・接続数の暴走を防ぐ）
+MAX_CONCURRENT_SEARCHES = int(os.getenv("CRAWLER_MAX_CONCURRENCY", "8"))
+
+# ─────────── 検索結果の共通フォーマットへの変換 ───────────
+_get_result_fields = operator.itemgetter("title", "content", "url")
+
+
+def _map_result(item: Dict[str, Any]) -> Dict[str, str]:
+    """{"title", "content", "url"} の検索結果を {"title", "description", "url"} に揃える"""
+    try:
+        title, content, url = _get_result_fields(item)
+    except KeyError:  # 欠けているキーがあるときだけ .get() で補う
+        title, content, url = item.get("title", ""), item.get("content", ""), item.get("url", "")
+    return {"title": title, "description": content, "url": url}
+
+
+# ─────────── Firecrawl REST API ───────────
+FIRECRAWL_BASE_URL = "https://api.firecrawl.dev"
+
+# ─────────── Tavily REST API ───────────
+TAVILY_BASE_URL = "https://api.tavily.com"
 
 
 class OpenAISearchApp:
@@ -22,15 +38,18 @@ class OpenAISearchApp:
     def __init__(self, api_key: str, model: str = "gpt-4.1"):
         if not api_key:
             raise ValueError("OPENAI_API_KEY is not set")
-        self.client = OpenAI(api_key=api_key)
+        # LLM 呼び出しと同じクライアント（接続プール）を使い回し、検索ごとの TCP/TLS ハンドシェイクを避ける
+        self.client = get_openai_client(api_key)
         self.model = model
-
-    def search(self, query: str, limit: int = 10, **kwargs):
-        resp = self.client.responses.create(
-            model=self.model,
-            tools=[{"type": "web_search_preview"}],
-            input=query,
-        )
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+
+    async def search(self, query: str, limit: int = 10, **kwargs):
+        async with self._sem:
+            resp = await self.client.responses.create(
+                model=self.model,
+                tools=[{"type": "web_search_preview"}],
+                input=query,
+            )
         # ① メッセージ要素を属性でフィルタ
         msg = next(o for o in resp.output if getattr(o, "type", None) == "message")
         # ② content[0] に .text, .annotations が詰まっている
@@ -51,59 +70,111 @@ class OpenAISearchApp:
         return SimpleNamespace(data=items)
 
 
-class TavilyApp:
-    """Tavily SDK を Firecrawl と同じインターフェースで扱う薄いラッパー。"""
+class FirecrawlApp:
+    """Firecrawl の検索 API を他のクローラと同じ async インターフェースで扱う薄いラッパー。
+
+    firecrawl-py は requests で毎回接続を張るため、REST API を共有の `httpx.AsyncClient` から
+    直接呼び、接続（keep-alive / HTTP/2）を使い回す。
+    """
 
     def __init__(self, api_key: str):
-        if _TavilySDK is None:
-            raise ImportError("Tavily SDK (tavily-python) がインストールされていません")
         if not api_key:
-            raise ValueError("TAVILY_API_KEY is not set")
-        self._client = _TavilySDK(api_key)       # ← _TavilySDK を使用
-
-    def search(self, query: str, limit: int = 10, **kwargs):
-        # SDK 呼び出しはそのまま
-        response: Dict[str, Any] = self._client.search(
-            query=query,
-            max_results=limit,
-            topic=kwargs.get("topic", "general"),
-            search_depth=kwargs.get("search_depth", "basic"),
-            days=kwargs.get("days", 30),
-            include_answer=False,
-            include_raw_content=False,
-            include_images=False,
+            raise ValueError("FIRECRAWL_KEY is not set")
+        self._client = httpx.AsyncClient(
+            base_url=FIRECRAWL_BASE_URL,
+            headers={"Authorization": f"Bearer {api_key}"},
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_SEARCHES,
+                max_keepalive_connections=MAX_CONCURRENT_SEARCHES,
+                keepalive_expiry=60.0,
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
         )
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
 
-        def _map(item: Dict[str, Any]) -> Dict[str, str]:
-            return {
-                "title": item.get("title", ""),
-                "description": item.get("content", ""),
-                "url": item.get("url", ""),
-            }
+    async def search(self, query: str, limit: int = 10, **kwargs):
+        async with self._sem:
+            resp = await self._client.post("/v1/search", json={"query": query, "limit": limit, **kwargs})
+        resp.raise_for_status()
+        # data は {"url", "title", "description"} の辞書のリスト
+        return SimpleNamespace(data=resp.json().get("data", []))
 
-        return SimpleNamespace(data=[_map(r) for r in response.get("results", [])[:limit]])
+
+class TavilyApp:
+    """Tavily の検索 API を Firecrawl と同じインターフェースで扱う薄いラッパー。
+
+    tavily-python の AsyncTavilyClient はリクエストごとに HTTP クライアントを作り直すため、
+    REST API を共有の `httpx.AsyncClient` から直接呼び、接続（keep-alive / HTTP/2）を使い回す。
+    """
+
+    def __init__(self, api_key: str):
+        if not api_key:
+            raise ValueError("TAVILY_API_KEY is not set")
+        self._client = httpx.AsyncClient(
+            base_url=TAVILY_BASE_URL,
+            headers={"Authorization": f"Bearer {api_key}"},
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_SEARCHES,
+                max_keepalive_connections=MAX_CONCURRENT_SEARCHES,
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+
+    async def search(self, query: str, limit: int = 10, **kwargs):
+        payload = {
+            "query": query,
+            "max_results": limit,
+            "topic": kwargs.get("topic", "general"),
+            "search_depth": kwargs.get("search_depth", "basic"),
+            "days": kwargs.get("days", 30),
+            "include_answer": False,
+            "include_raw_content": False,
+            "include_images": False,
+        }
+        async with self._sem:
+            resp = await self._client.post("/search", json=payload)
+        resp.raise_for_status()
+        response: Dict[str, Any] = resp.json()
+
+        # スライスのコピーを作らず、limit 件に達した時点で打ち切る
+        items = []
+        for item in response.get("results", ()):
+            if len(items) >= limit:
+                break
+            items.append(_map_result(item))
+        return SimpleNamespace(data=items)
 
 
 # ─────────── インターフェース (Protocol) ───────────
 class Crawler(Protocol):
-    def search(self, query: str, limit: int = 10, **kwargs): ...
+    """検索クローラの共通インターフェース。
+
+    実装は `search` の同時実行数を `MAX_CONCURRENT_SEARCHES` 以下に抑えること
+    （各ラッパーが `asyncio.Semaphore` を持つ）。
+    """
+
+    async def search(self, query: str, limit: int = 10, **kwargs): ...
 
 
 # ─────────── ファクトリ関数 ───────────
 def get_crawler() -> Crawler:
+    """SEARCH_PROVIDER に応じたクローラを返す（同じプロバイダならインスタンスを使い回す）"""
     provider = os.getenv("SEARCH_PROVIDER", "firecrawl").lower()
+    return _build_crawler(provider)
+
 
+@functools.lru_cache(maxsize=None)
+def _build_crawler(provider: str) -> Crawler:
     if provider == "firecrawl":
-        if _FirecrawlSDK is None:
-            raise ImportError("Firecrawl SDK がインストールされていません")
         key = os.getenv("FIRECRAWL_KEY")
         if not key:
             raise ValueError("FIRECRAWL_KEY が設定されていません")
-        return _FirecrawlSDK(api_key=key)
+        return FirecrawlApp(api_key=key)
 
     if provider == "tavily":
-        if _TavilySDK is None:
-            raise ImportError("Tavily SDK がインストールされていません")
         key = os.getenv("TAVILY_API_KEY")
         return TavilyApp(api_key=key)
 
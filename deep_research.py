@@ -1,13 +1,21 @@
 import os
+import re
 import json
 import asyncio
-from typing import List, Optional, Callable, Dict
-from pydantic import BaseModel, Field
-from dataclasses import dataclass, field
+import functools
+import hashlib
+import operator
+import time
+from typing import AsyncIterator, List, Optional, Callable, Dict, Tuple
+import pydantic_core
+from pydantic import BaseModel, Field, create_model
+from dataclasses import dataclass, replace
+from types import SimpleNamespace
 
-from openai import OpenAI
 from crawler_factory import get_crawler
-from datetime import datetime, timezone
+from openai_client import get_openai_client
+from llm_cache import llm_cached, semantic_cached
+from datetime import date, datetime, timezone
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -19,18 +27,45 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s %(message)s"
 )
 logger = logging.getLogger("app")  # 名前は任意
+# ログ用のプロセス ID（プロセス内で変わらないので一度だけ取得する）
+_PID = os.getpid()
 # ---------------------------------------------------------------------------
 # 「o3s」をデフォルトに、環境変数で上書き可
 LLM_MODEL = os.getenv("LLM_MODEL", "o3")
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
+# 処理ごとのモデル。知見抽出は呼び出し回数が最も多い単純な抽出タスクなので、推論なしの軽量モデルを使う
+MODELS = {
+    "queries": os.getenv("QUERY_MODEL", LLM_MODEL),
+    "extract": os.getenv("EXTRACT_MODEL", "gpt-4.1-mini"),
+    "report": os.getenv("REPORT_MODEL", LLM_MODEL),
+    # 追加調査の要否（真偽値 1 つ）を判定するだけなので軽量モデルで十分
+    "judge": os.getenv("JUDGE_MODEL", "gpt-4.1-mini"),
+}
+
+
+def _reasoning(model: str) -> dict:
+    """推論モデル（o 系・gpt-5 系）にだけ reasoning パラメータを付ける"""
+    if model.startswith(("o1", "o3", "o4", "gpt-5")):
+        return {"reasoning": {"effort": "medium"}}
+    return {}
+
+# 非同期クライアントにして、asyncio.gather の並列実行中も I/O 待ちを重ねられるようにする
+# （SEARCH_PROVIDER=openai の検索とも接続プールを共有する）
+client = get_openai_client(os.getenv("OPENAI_API_KEY"))
 web_crawler = get_crawler()
-
-
-def system_prompt() -> str:
-    now = datetime.now(timezone.utc).isoformat()
-    return f"""You are an expert researcher. Today is {now}. Follow these instructions when responding:
+# 同時に投げる LLM リクエスト数の上限（深さ×幅で膨らむ並列数を抑え、レート制限と接続の張り直しを防ぐ）
+# 検索側の同時実行数は各クローラのセマフォ（CRAWLER_MAX_CONCURRENCY）で制御している
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "16"))
+_LLM_SEM = asyncio.Semaphore(MAX_INFLIGHT)
+# 1 クエリあたり LLM に渡す検索結果の最大件数
+MAX_SERP_ITEMS = int(os.getenv("MAX_SERP_ITEMS", "8"))
+# true にすると、同じ階層の SERP 結果の知見抽出を 1 回の LLM 呼び出しにまとめる
+BATCH_SERP_PROCESSING = os.getenv("BATCH_SERP_PROCESSING", "false").lower() == "true"
+# true にすると、知見抽出の途中で次の階層の調査を始める（フォローアップ質問が出そろった時点で）
+PIPELINE_NEXT_LAYER = os.getenv("PIPELINE_NEXT_LAYER", "false").lower() == "true"
+
+
+# 静的な部分を先頭に固定し、プロバイダ側のプロンプトキャッシュ（先頭一致）を効かせる
+SYSTEM_PROMPT = """You are an expert researcher. Follow these instructions when responding:
 - You may be asked to research subjects that are after your knowledge cutoff; assume the user is right when presented with news.
 - The user is a highly experienced analyst, no need to simplify; be as detailed as possible and make sure your response is correct.
 - Be highly organized.
@@ -50,6 +85,85 @@ IMPORTANT:
 - All claims, arguments, and statements in the report must be directly traceable to the provided learnings.
 """
 
+# 同じ静的プレフィックスを持つリクエストを同じキャッシュへ振り分けるためのキー
+PROMPT_CACHE_KEY = "deep-research-" + hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+
+def system_prompt() -> str:
+    # 日付は日単位に丸めて末尾に置く（秒単位の時刻を先頭に入れるとキャッシュが毎回外れる）
+    return _system_prompt_for(datetime.now(timezone.utc).date())
+
+
+@functools.lru_cache(maxsize=1)
+def _system_prompt_for(today: date) -> str:
+    # 同じ日のあいだは同じ文字列を使い回す
+    return f"{SYSTEM_PROMPT}\nToday is {today.isoformat()}.\n"
+
+
+
+
+# 意味的キャッシュ用の埋め込みモデル
+EMBEDDING_MODEL = os.getenv("LLM_EMBEDDING_MODEL", "text-embedding-3-small")
+
+
+async def _embed(text: str) -> list[float]:
+    resp = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return resp.data[0].embedding
+
+
+# SDK の Pydantic → strict JSON Schema 変換（非公開 API なので、使えなければ公開 API の responses.parse を使う）
+try:
+    from openai.lib._parsing._responses import type_to_text_format_param
+except Exception:
+    type_to_text_format_param = None
+
+
+@functools.lru_cache(maxsize=None)
+def _text_format_param(text_format) -> Optional[dict]:
+    """スキーマごとに JSON Schema を一度だけ組み立て、毎回同じ内容のリクエストにする
+
+    非公開 API が無い、または SDK の変更で失敗した場合は None（呼び出し側は responses.parse を使う）。
+    """
+    if type_to_text_format_param is None:
+        return None
+    try:
+        param = type_to_text_format_param(text_format)
+    except Exception as e:
+        logger.warning("Building text.format for %s failed, using responses.parse: %r", text_format.__name__, e)
+        return None
+    return param if isinstance(param, dict) else None
+
+
+@llm_cached
+@semantic_cached(_embed)
+async def _parse_response(model: str, text_format, messages: list, **params):
+    """構造化出力を呼び出し、検証済みの結果を返す（同じ入力はキャッシュから返す）"""
+    text_param = _text_format_param(text_format)
+    async with _LLM_SEM:
+        if text_param is None:
+            resp = await client.responses.parse(
+                model=model,
+                input=messages,
+                text_format=text_format,
+                prompt_cache_key=PROMPT_CACHE_KEY,
+                **params,
+            )
+            return resp.output_parsed
+        resp = await client.responses.create(
+            model=model,
+            input=messages,
+            text={"format": text_param},
+            prompt_cache_key=PROMPT_CACHE_KEY,
+            **params,
+        )
+    usage = getattr(resp, "usage", None)
+    if usage is not None and usage.input_tokens_details is not None:
+        # プロンプトキャッシュの効き具合（先頭一致でキャッシュから読まれたトークン数）
+        logger.debug(
+            "LLM USAGE: %s | input=%d cached=%d",
+            text_format.__name__, usage.input_tokens, usage.input_tokens_details.cached_tokens,
+        )
+    return text_format.model_validate_json(resp.output_text)
 
 
 @dataclass
@@ -61,7 +175,6 @@ class ResearchProgress:
     total_queries: int = 0
     completed_queries: int = 0
     current_query: Optional[str] = None
-    new_learnings: list[str] = field(default_factory=list)
 
 @dataclass
 class ResearchResult:
@@ -97,6 +210,8 @@ class QueryList(BaseModel):
         description="List of search queries, max of the requested number"
     )
 
+_get_description = operator.itemgetter("description")
+
 # ② process_serp_result 用のスキーマ
 class ProcResponse(BaseModel):
     learnings: List[str] = Field(
@@ -111,6 +226,19 @@ class ProcResponse(BaseModel):
         description="List of follow-up questions to research the topic further, max of the requested number."
     )
 
+# ProcResponse と同じ項目を followUpQuestions → learnings の順に並べたもの（ストリーミングで先に質問を得る）
+_FollowUpFirstProcResponse = create_model(
+    "ProcResponse",
+    followUpQuestions=(List[str], ProcResponse.model_fields["followUpQuestions"]),
+    learnings=(List[str], ProcResponse.model_fields["learnings"]),
+)
+
+class BatchProcResponse(BaseModel):
+    results: List[ProcResponse] = Field(
+        ...,
+        description="One entry per <query> block, in the same order as the queries are given."
+    )
+
 # ③ 最終レポート用のスキーマ
 class FinalReport(BaseModel):
     reportMarkdown: str = Field(..., description="Final report on the topic in Markdown")
@@ -156,25 +284,26 @@ async def generate_followup(
         f"\n{query}"
     )
 
-    # structured output を _FeedbackSchema で指定
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
-        input=[
+    # structured output を FollowUpQuestion で指定
+    parsed = await _parse_response(
+        MODELS["queries"],
+        FollowUpQuestion,
+        [
             {"role": "system", "content": fowllowup_system_prompt},
             {"role": "user",   "content": prompt},
         ],
-        text_format=FollowUpQuestion,
-    )
-
-    parsed = resp.output_parsed        # ← Pydantic で検証済み
+        **_reasoning(MODELS["queries"]),
+    )                                  # ← Pydantic で検証済み
     return parsed.questions[:num_questions]
 
-# ---------------------------------------------------------------------------
-# generate_followup 同期ラッパー（Streamlit など同期環境向け）
-# ---------------------------------------------------------------------------
-def generate_followup_sync(query: str, num_questions: int = 3) -> List[str]:
-    return asyncio.run(generate_followup(query, num_questions))
+
+_SERP_QUERIES_INSTRUCTIONS = (
+    "ユーザーからのプロンプト（<prompt> タグ）に基づき、このトピックを調査するための検索クエリをリストアップして。\n"
+    "最大で <max_queries> タグの個数までクエリを返して。 ただし、元のプロンプトが明確な場合は、それより少なくても構わない。\n"
+    "それぞれのクエリがユニークで、互いに類似しないようにして。\n"
+    "<learnings> タグがある場合は、以前の調査から得られたlearningsです。これらを参考に、learningsと重複しない検索クエリを作成して。\n"
+    "\n---\n"
+)
 
 
 async def generate_serp_queries(
@@ -183,32 +312,80 @@ async def generate_serp_queries(
     learnings: Optional[List[str]] = None,
 ) -> List[Dict[str, str]]:
     
-    prompt = (
-        f"ユーザーからの以下のプロンプトに基づき、このトピックを調査するための検索クエリをリストアップして。\n"
-        f"最大で{num_queries}個までクエリを返して。 ただし、元のプロンプトが明確な場合は、それより少なくても構わない。\n"
-        f"それぞれのクエリがユニークで、互いに類似しないようにして: <prompt>{query}</prompt>\n\n"
+    # 固定の指示を先頭に、呼び出しごとに変わる内容を末尾にまとめる（プロンプトキャッシュの先頭一致を長く保つ）
+    payload = (
+        f"<max_queries>{num_queries}</max_queries>\n"
+        f"<prompt>{query}</prompt>\n"
     )
     if learnings:
-        prompt += (
-            "以前の調査から得られたlearningsを以下に示します。これらを参考に、learningsと重複しない検索クエリを作成して:\n"
-            + "\n".join(learnings)
-        )
+        payload += "\n<learnings>\n" + "\n".join(learnings) + "\n</learnings>"
+    prompt = _SERP_QUERIES_INSTRUCTIONS + payload
 
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
-        input=[
+    parsed = await _parse_response(
+        MODELS["queries"],
+        QueryList,
+        [
             {"role": "system", "content": system_prompt()},
             {"role": "user",   "content": prompt},
         ],
-        text_format=QueryList,
+        **_reasoning(MODELS["queries"]),
+        # 言い換えただけのプロンプトなら、過去に生成したクエリを使い回す（固定の指示は比較に含めない）
+        semantic_text=payload,
     )
-    parsed = resp.output_parsed
     # print("----- RAW generate_serp_queries START -----")
     # print(parsed)
     # print("----- RAW generate_serp_queries  END  -----")
 
-    return [entry.model_dump() for entry in parsed.queries][:num_queries]
+    # 検証済みの 2 項目を読むだけなので、汎用のシリアライザを通さず直接 dict にする
+    return [{"query": e.query, "researchGoal": e.researchGoal} for e in parsed.queries[:num_queries]]
+
+
+# 検索結果 1 件あたりの最大文字数（長い定型文でプロンプトが膨らむのを防ぐ）
+MAX_CONTENT_CHARS = int(os.getenv("MAX_CONTENT_CHARS", "1500"))
+
+
+def _wrap_contents(search_result) -> str:
+    """検索結果の本文を <content> タグで包む
+
+    空白と大文字小文字を無視して同じ内容のものは最初の 1 件だけ残し、各本文は
+    MAX_CONTENT_CHARS 文字で切り詰める。
+    """
+    unique: Dict[str, str] = {}
+    for c in map(_get_description, search_result.data):
+        if not c:
+            continue
+        unique.setdefault(" ".join(c.lower().split()), c)
+    return "\n".join(f"<content>\n{c[:MAX_CONTENT_CHARS]}\n</content>" for c in unique.values())
+
+
+_LEARNING_RULES = (
+    "Each learning should:\n"
+    "- Be unique and non-overlapping\n"
+    "- Be detailed and explanatory, not just short summaries\n"
+    "- Include context such as who/what/when/why/how\n"
+    "- Mention relevant entities (e.g., people, organizations, events)\n"
+    "- Include metrics, dates, or quotes where relevant\n"
+    "- Be self-contained so it makes sense without reading the source\n\n"
+    "The output will help guide deeper research and should be as informative as possible.\n"
+)
+
+_SERP_INSTRUCTIONS = (
+    "Given the contents from a SERP search for the query in the <query> tag below, "
+    "generate a list of learnings from the contents. Return at most the number of learnings given in "
+    "the <max_learnings> tag, but feel free to return less if the contents are clear.\n\n"
+    + _LEARNING_RULES
+    + "\n---\n"
+)
+
+
+def _serp_prompt(query: str, wrapped: str, num_learnings: int) -> str:
+    # 固定の指示が先頭、クエリ・本文など呼び出しごとに変わる内容は末尾
+    return (
+        _SERP_INSTRUCTIONS
+        + f"<max_learnings>{num_learnings}</max_learnings>\n"
+        f"<query>{query}</query>\n\n"
+        f"<contents>\n{wrapped}\n</contents>"
+    )
 
 
 async def process_serp_result(
@@ -216,43 +393,23 @@ async def process_serp_result(
     search_result,
     num_learnings: int = 3,
 ) -> Dict[str, List[str]]:
-    # item は dict なので ['description'] で取得
-    contents = [item["description"] for item in search_result.data]
-    # 各コンテンツを <content> タグでラップ
-    wrapped = "\n".join(f"<content>\n{c}\n</content>" for c in contents)
-
-    # Build the prompt exactly as in the original, using an f-string
-    prompt = (
-        f"Given the following contents from a SERP search for the query <query>{query}</query>, "
-        f"generate a list of learnings from the contents. Return a maximum of {num_learnings} "
-        "learnings, but feel free to return less if the contents are clear.\n\n"
-        "Each learning should:\n"
-        "- Be unique and non-overlapping\n"
-        "- Be detailed and explanatory, not just short summaries\n"
-        "- Include context such as who/what/when/why/how\n"
-        "- Mention relevant entities (e.g., people, organizations, events)\n"
-        "- Include metrics, dates, or quotes where relevant\n"
-        "- Be self-contained so it makes sense without reading the source\n\n"
-        "The output will help guide deeper research and should be as informative as possible.\n\n"
-        f"<contents>\n{wrapped}\n</contents>"
-    )
+    # 各コンテンツを（重複除去・切り詰めのうえ）<content> タグでラップ
+    wrapped = _wrap_contents(search_result)
+    prompt = _serp_prompt(query, wrapped, num_learnings)
 
 
     # structured output を Pydantic モデルで指定
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
-        input=[
+    parsed = await _parse_response(
+        MODELS["extract"],
+        ProcResponse,
+        [
             {"role": "system", "content": system_prompt()},
             {"role": "user",   "content": prompt},
         ],
-        text_format=ProcResponse,
+        **_reasoning(MODELS["extract"]),
+        # 言い換えただけのクエリと同じような検索結果なら、過去の抽出結果を使い回す
+        semantic_text=f"{query}\n{wrapped}",
     )
-    # debug
-    # print(json.dumps(resp.model_dump(), indent=2, ensure_ascii=False))\
-
-    # 解析済み結果を取得
-    parsed = resp.output_parsed
     # print("----- RAW process_serp_result START -----")
     # print(parsed)
     # print("----- RAW process_serp_result  END  -----")
@@ -262,77 +419,224 @@ async def process_serp_result(
         "followUpQuestions": parsed.followUpQuestions,
     }
 
+async def process_serp_result_pipelined(
+    query: str,
+    search_result,
+    num_learnings: int,
+    on_followups: Callable[[List[str]], None],
+) -> Dict[str, List[str]]:
+    """
+    process_serp_result のストリーミング版。followUpQuestions を先に生成させ、
+    それが出そろった時点で（learnings の生成完了を待たずに）`on_followups` を呼ぶ。
+    """
+    wrapped = _wrap_contents(search_result)
+    buf: List[str] = []
+    fired = False
+    async with _LLM_SEM, client.responses.stream(
+        model=MODELS["extract"],
+        **_reasoning(MODELS["extract"]),
+        input=[
+            {"role": "system", "content": system_prompt()},
+            {"role": "user",   "content": _serp_prompt(query, wrapped, num_learnings)},
+        ],
+        text_format=_FollowUpFirstProcResponse,
+        prompt_cache_key=PROMPT_CACHE_KEY,
+    ) as stream:
+        async for event in stream:
+            if fired or event.type != "response.output_text.delta":
+                continue
+            buf.append(event.delta)
+            # "learnings" キーが現れた = その前の followUpQuestions 配列は完成している
+            partial = pydantic_core.from_json("".join(buf), allow_partial=True)
+            if isinstance(partial, dict) and "learnings" in partial:
+                on_followups(partial["followUpQuestions"])
+                fired = True
+        parsed = (await stream.get_final_response()).output_parsed
+
+    if not fired:
+        on_followups(parsed.followUpQuestions)
+    return {
+        "learnings": parsed.learnings,
+        "followUpQuestions": parsed.followUpQuestions,
+    }
+
+
+_BATCH_SERP_INSTRUCTIONS = (
+    "Below are the contents from several SERP searches, each labelled with its query number. "
+    "For EACH query, in order, generate a list of learnings from its own contents only. "
+    "Return at most the number of learnings given in the <max_learnings> tag per query, "
+    "but feel free to return less if the contents are clear.\n\n"
+    + _LEARNING_RULES
+    + "\n---\n"
+)
+
+
+async def process_serp_results_batch(
+    queries: List[str],
+    search_results: list,
+    num_learnings: int = 3,
+) -> List[Dict[str, List[str]]]:
+    """複数の SERP 結果から、知見とフォローアップ質問を 1 回の呼び出しでまとめて抽出する
+
+    返ってきた件数がクエリ数に足りない場合、足りない分だけ process_serp_result で個別に処理する。
+    """
+    blocks = []
+    for i, (query, search_result) in enumerate(zip(queries, search_results), 1):
+        wrapped = _wrap_contents(search_result)
+        blocks.append(f"<query {i}>{query}</query {i}>\n<contents {i}>\n{wrapped}\n</contents {i}>")
+
+    prompt = _BATCH_SERP_INSTRUCTIONS + f"<max_learnings>{num_learnings}</max_learnings>\n\n" + "\n\n".join(blocks)
+
+    parsed = await _parse_response(
+        MODELS["extract"],
+        BatchProcResponse,
+        [
+            {"role": "system", "content": system_prompt()},
+            {"role": "user",   "content": prompt},
+        ],
+        **_reasoning(MODELS["extract"]),
+    )
+
+    procs = [
+        {"learnings": r.learnings, "followUpQuestions": r.followUpQuestions}
+        for r in parsed.results[:len(queries)]
+    ]
+    if len(procs) < len(queries):
+        logger.warning("Batch processing returned %d/%d results; processing the rest one by one", len(procs), len(queries))
+        procs += await asyncio.gather(*(
+            process_serp_result(q, sr, num_learnings=num_learnings)
+            for q, sr in zip(queries[len(procs):], search_results[len(procs):])
+        ))
+    return procs
+
+def learnings_block(learnings: List[str]) -> str:
+    """learnings を <learning> タグで包んだ文字列にする（レポートと回答で使い回せる）"""
+    return "\n".join(f"<learning>\n{l}\n</learning>" for l in learnings)
+
+
+_FINAL_REPORT_INSTRUCTIONS = (
+    "Based on the following user prompt, write a final report using ONLY the information provided in the <learnings> tags. "
+    "Do NOT add any additional information, assumptions, or external knowledge. "
+    "However, if the learnings are fragmented or incomplete, you may connect them logically to create a coherent structure. "
+    "Organize the report with a clear and consistent structure, including appropriate sections such as Introduction, Background, Summary of Findings, Discussion, and Conclusion. "
+    "Where relevant, merge similar points or clarify relationships such as chronology or causality. "
+    "Do not generalize beyond what is explicitly stated.\n"
+    "\n---\n"
+)
+
+
+def _final_report_message(prompt: str, learnings_str: str) -> str:
+    # 固定の指示が先頭、プロンプトと知見は末尾
+    return _FINAL_REPORT_INSTRUCTIONS + f"<prompt>\n{prompt}\n</prompt>\n\n<learnings>\n{learnings_str}\n</learnings>"
+
+
+def _sources_section(visited_urls: List[str]) -> str:
+    return "\n\n## Sources\n\n" + "\n".join(f"- {u}" for u in visited_urls)
+
+
 # 最終レポート作成
 async def write_final_report(
     prompt: str,
     learnings: List[str],
     visited_urls: List[str],
+    learnings_str: Optional[str] = None,
 ) -> str:
-    learnings_str = "\n".join(f"<learning>\n{l}\n</learning>" for l in learnings)
-    user_message = (
-        f"Based on the following user prompt, write a final report using ONLY the information provided in the <learnings> tags. "
-        "Do NOT add any additional information, assumptions, or external knowledge. "
-        "However, if the learnings are fragmented or incomplete, you may connect them logically to create a coherent structure. "
-        "Organize the report with a clear and consistent structure, including appropriate sections such as Introduction, Background, Summary of Findings, Discussion, and Conclusion. "
-        "Where relevant, merge similar points or clarify relationships such as chronology or causality. "
-        "Do not generalize beyond what is explicitly stated.\n\n"
-        f"<prompt>\n{prompt}\n</prompt>\n\n"
-        f"<learnings>\n{learnings_str}\n</learnings>"
+    parsed = await _parse_response(
+        MODELS["report"],
+        FinalReport,
+        [
+            {"role": "system", "content": system_prompt()},
+            {"role": "user",   "content": _final_report_message(prompt, learnings_str or learnings_block(learnings))},
+        ],
+        **_reasoning(MODELS["report"]),
     )
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
+    return parsed.reportMarkdown + _sources_section(visited_urls)
+
+
+# 最終レポート作成（ストリーミング版）
+async def write_final_report_stream(
+    prompt: str,
+    learnings: List[str],
+    visited_urls: List[str],
+    learnings_str: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    最終レポートの Markdown を生成されたそばから少しずつ返す（最後に Sources 節を返す）。
+    構造化出力だと JSON の断片が届くため、こちらはレポート本文をそのままテキストで出力させる。
+    """
+    user_message = _final_report_message(prompt, learnings_str or learnings_block(learnings)) + "\n\nRespond with the report in Markdown only."
+    async with _LLM_SEM, client.responses.stream(
+        model=MODELS["report"],
+        **_reasoning(MODELS["report"]),
         input=[
             {"role": "system", "content": system_prompt()},
             {"role": "user",   "content": user_message},
         ],
-        text_format=FinalReport,
-    )
-    # debug
-    # print(json.dumps(resp.model_dump(), indent=2, ensure_ascii=False))
+        prompt_cache_key=PROMPT_CACHE_KEY,
+    ) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+    yield _sources_section(visited_urls)
+
+_FINAL_ANSWER_INSTRUCTIONS = (
+    "Given the following prompt from the user, write a final answer on the topic using the learnings from research. "
+    "Write a final report with prompt language. Follow the format specified in the prompt. "
+    "Do not yap or babble or include any other text than the answer besides the format specified in the prompt. "
+    "Keep the answer as concise as possible - usually it should be just a few words or maximum a sentence. "
+    "Try to follow the format specified in the prompt.\n"
+    "\n---\n"
+)
 
-    parsed = resp.output_parsed
-    urls_section = "\n\n## Sources\n\n" + "\n".join(f"- {u}" for u in visited_urls)
-    return parsed.reportMarkdown + urls_section
 
 # 最終回答作成
 async def write_final_answer(
     prompt: str,
     learnings: List[str],
+    learnings_str: Optional[str] = None,
 ) -> str:
-    learnings_str = "\n".join(f"<learning>\n{l}\n</learning>" for l in learnings)
-    user_message = (
-        f"Given the following prompt from the user, write a final answer on the topic using the learnings from research. "
-        "Write a final report with prompt language. Follow the format specified in the prompt. "
-        "Do not yap or babble or include any other text than the answer besides the format specified in the prompt. "
-        "Keep the answer as concise as possible - usually it should be just a few words or maximum a sentence. "
-        "Try to follow the format specified in the prompt.\n\n"
-        f"<prompt>{prompt}</prompt>\n\n"
-        f"<learnings>\n{learnings_str}\n</learnings>"
-    )
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
-        input=[
+    learnings_str = learnings_str or learnings_block(learnings)
+    user_message = _FINAL_ANSWER_INSTRUCTIONS + f"<prompt>{prompt}</prompt>\n\n<learnings>\n{learnings_str}\n</learnings>"
+    parsed = await _parse_response(
+        MODELS["report"],
+        FinalAnswer,
+        [
             {"role": "system", "content": system_prompt()},
             {"role": "user",   "content": user_message},
         ],
-        text_format=FinalAnswer,
+        **_reasoning(MODELS["report"]),
     )
-    # debug
-    # print(json.dumps(resp.model_dump(), indent=2, ensure_ascii=False))
-
-    parsed = resp.output_parsed
     return parsed.exactAnswer
 
 
+async def _run_branches(coros) -> None:
+    """
+    兄弟ブランチを並列に走らせ、終わったものから順に片付ける。
+    1 本が失敗してもログに残して残りを続け、すべて失敗したときだけ最初の例外を送出する。
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    errors: List[BaseException] = []
+    try:
+        for fut in asyncio.as_completed(tasks):
+            try:
+                await fut
+            except Exception as e:
+                logger.exception("Research branch failed: %s", e)
+                errors.append(e)
+    finally:
+        for t in tasks:
+            t.cancel()  # 呼び出し元がキャンセルされた場合に残りを止める（完了済みには影響しない）
+    if tasks and len(errors) == len(tasks):
+        raise errors[0]
+
+
 async def deep_research(
     query: str,
     breadth: int,
     depth: int,
     learnings: Optional[List[str]] = None,
     visited_urls: Optional[List[str]] = None,
-    on_progress: Optional[Callable[[ResearchProgress], None]] = None,
+    on_progress: Optional[Callable[[ResearchProgress, Tuple[str, ...]], None]] = None,
 ) -> ResearchResult:
     """
     再帰的にウェブリサーチを実行し、「幅 (breadth) × 深さ (depth)」で検索範囲を
@@ -351,13 +655,12 @@ async def deep_research(
         これまでに得た知見の蓄積。再帰で下層へ渡し、最後に重複除去して返す。
     visited_urls : list[str] | None
         既にクロールした URL の集合。最終結果用なので途中処理では使わない。
-    on_progress : Callable[[ResearchProgress], None] | None
-        進捗を通知するコールバック。呼び出しタイミングは下記 3 つ。  
+    on_progress : Callable[[ResearchProgress, tuple[str, ...]], None] | None
+        進捗を通知するコールバック。呼び出しタイミングは下記 2 つ。  
         1. 最初の SERP クエリを生成した直後  
-        2. 各クエリを処理し「新しい learnings」が得られた直後  
-        3. 深さ・幅を更新した直後  
-        `ResearchProgress.new_learnings` に **今回増えた分だけ** が入るので、
-        フロントエンドでリアルタイムに追加表示できる。
+        2. 各クエリの処理が終わり、進捗（件数・深さ・幅）が進んだ直後  
+        第 1 引数は進捗のスナップショット（コピー）、第 2 引数には **今回増えた learnings だけ** が
+        入るので、フロントエンドでリアルタイムに追加表示できる。
 
     戻り値
     ------
@@ -369,24 +672,50 @@ async def deep_research(
     ----------
     1. `generate_serp_queries()` で次に検索すべきキーワードを LLM で生成  
     2. 各キーワードについて:  
-       2-a. `web_crawler.search()` でページをクロール  
+       2-a. `await web_crawler.search()` でページをクロール  
        2-b. `process_serp_result()` で知見と次の調査質問を抽出  
-       2-c. `on_progress()` に新しい知見を通知  
+       2-c. `on_progress()` に進捗と新しい知見をまとめて通知  
     3. `depth > 1` の場合は、質問リストをまとめた新しいクエリを作り再帰呼び出し  
        （breadth を半減、depth を 1 減らす）  
-    4. 末端まで到達したら各レイヤーから `ResearchResult` を集約し、  
-       URL と知見をそれぞれ集合演算で重複排除して返す。
+    4. 各ノードの知見と URL は挿入順を保つ辞書 1 つずつに追加していき、  
+       最後にそれをリストにして `ResearchResult` として返す（重複排除済み）。
 
     備考
     ----
-    - 同一レイヤーの SERP クエリは `asyncio.gather()` で並列実行し高速化。  
+    - 同一レイヤーの SERP クエリは並列実行し、終わったものから順に片付ける（一部の失敗では止めない）。  
     - 再帰は逐次進むため、深さ方向の制御はシンプル。  
     - `on_progress` を使えば Streamlit などで進捗バーと知見ログを
       同期的に更新できる。
     """
 
-    learnings = learnings or []
-    visited_urls = visited_urls or []
+    learnings = list(learnings or [])
+    # 全ノードの知見・URL を 1 つの辞書（挿入順を保つ集合）に集約し、途中のリスト連結と最後の重複排除を省く
+    seen_learnings = dict.fromkeys(learnings)
+    seen_urls = dict.fromkeys(visited_urls or [])
+
+    seen_queries: Dict[str, None] = {}
+
+    await _deep_research(query, breadth, depth, learnings, seen_learnings, seen_urls, seen_queries, on_progress)
+
+    return ResearchResult(list(seen_learnings), list(seen_urls))
+
+
+async def _deep_research(
+    query: str,
+    breadth: int,
+    depth: int,
+    learnings: List[str],
+    seen_learnings: Dict[str, None],
+    seen_urls: Dict[str, None],
+    seen_queries: Dict[str, None],
+    on_progress: Optional[Callable[[ResearchProgress, Tuple[str, ...]], None]],
+) -> None:
+    """deep_research の再帰本体。得られた知見と URL は seen_learnings / seen_urls に追加する。
+
+    seen_queries には実行済みの SERP クエリ（正規化したもの）を記録し、他のブランチと同じクエリは実行しない。
+
+    `learnings` はこのノードまでの経路で得た知見で、次の SERP クエリ生成のプロンプトにだけ使う。
+    """
 
     # Progress オブジェクト生成
     progress = ResearchProgress(
@@ -398,24 +727,64 @@ async def deep_research(
 
     # ① 最初の SERP クエリ生成
     serp_queries = await generate_serp_queries(query, breadth, learnings)
+    # 大文字小文字・空白だけが違うクエリは、他のブランチで実行済みなら検索も LLM 呼び出しも省く
+    unique_queries = []
+    for serp in serp_queries:
+        key = " ".join(serp["query"].lower().split())
+        if key not in seen_queries:
+            seen_queries[key] = None
+            unique_queries.append(serp)
+    serp_queries = unique_queries
     progress.total_queries = len(serp_queries)
     progress.current_query = serp_queries[0]["query"] if serp_queries else None
 
-    # ── コールバック：new_learnings はまだ空 ──
-    if on_progress:
-        on_progress(progress)
+    def notify(new_learnings: Tuple[str, ...] = ()) -> None:
+        # 共有の progress は後から書き換わるので、コピーを渡す
+        if on_progress:
+            on_progress(replace(progress), new_learnings)
+
+    # ── コールバック：新しい learnings はまだ無い ──
+    notify()
 
     # ② 各クエリを処理する補助コルーチン ----------------
-    async def handle_one(serp: Dict[str, str]) -> ResearchResult:
-        # web_crawler 検索（同期 API）
-        process_id = os.getpid()
-        query_str = serp["query"]
-        logger.info(
-            f"SEARCH QUERY: '{query_str}' | pid={process_id}"
+    async def search_one(serp: Dict[str, str]):
+        # web_crawler 検索（非同期 API）
+        # 出力されるときだけ文字列を組み立てるよう、引数は % 形式で渡す
+        logger.info("SEARCH QUERY: '%s' | pid=%d", serp["query"], _PID)
+        search_result = await web_crawler.search(serp["query"], limit=breadth)
+
+        # 他のブランチや上の階層で既に処理したページは除き、件数も上限で切る
+        fresh = [item for item in search_result.data if item["url"] not in seen_urls][:min(breadth, MAX_SERP_ITEMS)]
+        seen_urls.update(dict.fromkeys(item["url"] for item in fresh))
+        return SimpleNamespace(data=fresh)
+
+    def next_layer(serp: Dict[str, str], followups: List[str], path_learnings: List[str]):
+        next_query = (
+            f"Previous research goal: {serp.get('researchGoal')}\n"
+            + "\n".join(f"- {q}" for q in followups)
         )
-        search_result = web_crawler.search(serp["query"], limit=breadth)
+        return _deep_research(
+            next_query,
+            breadth // 2,
+            depth - 1,
+            path_learnings,
+            seen_learnings,
+            seen_urls,
+            seen_queries,
+            on_progress,
+        )
+
+    async def handle_one(serp: Dict[str, str]) -> None:
+        started = time.perf_counter()
+        search_result = await search_one(serp)
+        if not search_result.data:
+            # 新しいページが無ければ LLM を呼ばず、このブランチはここで終える
+            finish_leaf(serp)
+            return
 
-        new_urls = [item["url"] for item in search_result.data]
+        if PIPELINE_NEXT_LAYER and depth - 1 > 0:
+            await handle_one_pipelined(serp, search_result)
+            return
 
         # SERP 結果を解析し、learnings と follow-up 質問を抽出
         proc = await process_serp_result(
@@ -423,64 +792,142 @@ async def deep_research(
             search_result,
             num_learnings=breadth,
         )
+        # 兄弟クエリの検索・抽出が重なって走っているかをログの時刻で確認できるようにする
+        logger.info("SERP DONE: '%s' | %.2fs", serp["query"], time.perf_counter() - started)
+        await continue_one(serp, proc)
 
-        # 最新 learnings を progress にセット → UI へ即通知
-        progress.new_learnings = proc["learnings"]
-        if on_progress:
-            on_progress(progress)
+    async def handle_one_pipelined(serp: Dict[str, str], search_result) -> None:
+        # フォローアップ質問が出そろった時点で次の階層を走らせ、知見抽出の残りと重ねる
+        # （次の階層のクエリ生成には、このノードの learnings はまだ含まれない）
+        tasks: List[asyncio.Task] = []
 
-        # 累積
-        all_learnings = learnings + proc["learnings"]
-        all_urls = visited_urls + new_urls
+        def _start(followups: List[str]) -> None:
+            tasks.append(asyncio.create_task(next_layer(serp, followups, learnings)))
 
-        # ---------- 深さが残っている場合は再帰 ----------
-        if depth - 1 > 0:
-            next_query = (
-                f"Previous research goal: {serp.get('researchGoal')}\n"
-                + "\n".join(f"- {q}" for q in proc["followUpQuestions"])
+        try:
+            proc = await process_serp_result_pipelined(
+                serp["query"], search_result, breadth, on_followups=_start
             )
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+        await continue_one(serp, proc, next_task=tasks[0])
+
+    async def continue_one(
+        serp: Dict[str, str],
+        proc: Dict[str, List[str]],
+        next_task: Optional[asyncio.Task] = None,
+    ) -> None:
+        # 累積
+        seen_learnings.update(dict.fromkeys(proc["learnings"]))
 
-            # 進捗更新
-            progress.completed_queries += 1
-            progress.current_depth = depth - 1
+        # 進捗更新と新しい learnings の通知は 1 回にまとめる
+        count_done(serp)
+        progress.current_depth = depth - 1
+        if depth - 1 > 0:
             progress.current_breadth = breadth // 2
-            # 直後の再帰で new_learnings が再度上書きされるので、一旦空に
-            progress.new_learnings = []
-
-            if on_progress:
-                on_progress(progress)
-
-            return await deep_research(
-                next_query,
-                breadth=breadth // 2,
-                depth=depth - 1,
-                learnings=all_learnings,
-                visited_urls=all_urls,
-                on_progress=on_progress,
-            )
-
-        # ---------- 末端ノード ----------
-        progress.completed_queries += 1
-        progress.current_depth = 0
-        progress.new_learnings = []        # 最後は空にしておく
+        notify(tuple(proc["learnings"]))
         if on_progress:
-            on_progress(progress)
-
-        return ResearchResult(all_learnings, all_urls)
-
-    # ③ すべての SERP クエリを並列実行
-    results = await asyncio.gather(*(handle_one(q) for q in serp_queries))
-
-    # ④ 重複排除して統合
-    final_learnings = list({l for r in results for l in r.learnings})
-    final_urls      = list({u for r in results for u in r.visited_urls})
-
-    return ResearchResult(final_learnings, final_urls)
+            # コールバック（UI 描画）の後は一度ループに制御を返し、待機中の I/O を先に進める
+            await asyncio.sleep(0)
 
+        # ---------- 深さが残っている場合は再帰 ----------
+        if depth - 1 > 0:
+            if next_task is not None:
+                await next_task  # 先行して始めた次の階層の完了を待つ
+            else:
+                await next_layer(serp, proc["followUpQuestions"], learnings + proc["learnings"])
+
+    # 完了として数えたクエリ（失敗したブランチを数え漏らさず、二重にも数えないため）
+    counted: Dict[str, None] = {}
+
+    def count_done(serp: Dict[str, str]) -> bool:
+        if serp["query"] in counted:
+            return False
+        counted[serp["query"]] = None
+        progress.completed_queries += 1
+        return True
 
+    def finish_leaf(serp: Dict[str, str]) -> None:
+        count_done(serp)
+        progress.current_depth = 0
+        notify()
+
+    async def branch(serp: Dict[str, str], coro) -> None:
+        # 失敗したブランチも完了として数え、進捗が 100% に届かないまま止まらないようにする
+        try:
+            await coro
+        except Exception:
+            if count_done(serp):
+                notify()
+            raise
+
+    # ③ すべての SERP クエリを並列実行（結果は seen_learnings / seen_urls に集まる）
+    if BATCH_SERP_PROCESSING and len(serp_queries) > 1:
+        # 検索だけ先に並列で済ませ、知見抽出は 1 回の LLM 呼び出しにまとめる
+        # 1 件の検索が失敗（429 など）しても階層全体を捨てないよう、失敗したクエリだけ除く
+        results = await asyncio.gather(*(search_one(q) for q in serp_queries), return_exceptions=True)
+        searched: List[Tuple[Dict[str, str], SimpleNamespace]] = []
+        errors: List[BaseException] = []
+        for serp, r in zip(serp_queries, results):
+            if isinstance(r, BaseException):
+                logger.error("Search failed for '%s': %r", serp["query"], r)
+                errors.append(r)
+                count_done(serp)
+            else:
+                searched.append((serp, r))
+        if errors:
+            notify()
+        if not searched:
+            raise errors[0]
+
+        # 新しいページが無いクエリは LLM に渡さず、そのブランチはここで終える（handle_one と同じ）
+        batch: List[Tuple[Dict[str, str], SimpleNamespace]] = []
+        for serp, r in searched:
+            if r.data:
+                batch.append((serp, r))
+            else:
+                finish_leaf(serp)
+        if not batch:
+            return
+
+        try:
+            procs = await process_serp_results_batch(
+                [serp["query"] for serp, _ in batch], [r for _, r in batch], num_learnings=breadth
+            )
+        except Exception:
+            for serp, _ in batch:
+                count_done(serp)
+            notify()
+            raise
+        await _run_branches(branch(serp, continue_one(serp, p)) for (serp, _), p in zip(batch, procs))
+    else:
+        await _run_branches(branch(q, handle_one(q)) for q in serp_queries)
+
+
+
+
+# 追加調査の要否判定で、LLM を呼ばずに済ませる条件
+JUDGE_MIN_LEARNINGS = int(os.getenv("JUDGE_MIN_LEARNINGS", "10"))
+# 質問の主要な語（英数字 3 文字以上・カタカナ 2 文字以上・漢字 2 文字以上の並び）
+_KEY_TERM_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_\-]{2,}|[\u30A0-\u30FF]{2,}|[\u4E00-\u9FFF]{2,}")
+
+_JUDGE_INSTRUCTIONS = (
+    "The user's research question and the learnings collected so far are given after the --- line.\n\n"
+    "### Task\n"
+    "1. Critically evaluate whether the learnings already provide a complete and well-supported answer to the question.\n"
+    "2. Examine the coverage from multiple angles (e.g., factual accuracy, depth, timeliness, opposing viewpoints, remaining unknowns).\n"
+    "3. Decide if additional research is required.\n\n"
+    "### Response format\n"
+    "Return **exactly one word** (case-insensitive):\n"
+    "- `yes`  → Follow-up research is still needed.\n"
+    "- `no`   → The learnings are sufficient; no further research is required.\n"
+    "\n---\n"
+)
 
 
-def judge_followup_required(
+async def judge_followup_required(
     query: str,
     learnings: Optional[List[str]] = None,
 ) -> bool:
@@ -502,35 +949,28 @@ def judge_followup_required(
     if not learnings:
         return True
 
+    # 知見が十分な件数あり、質問の主要な語がすべて知見に含まれていれば LLM を呼ばずに「不要」とする
+    if len(learnings) >= JUDGE_MIN_LEARNINGS and len(set(learnings)) == len(learnings):
+        terms = _KEY_TERM_RE.findall(query)
+        joined = " ".join(learnings).lower()
+        if terms and all(t.lower() in joined for t in terms):
+            return False
+
     # OpenAIを使って、queryとlearningsをInputし。followup researchが必要かを判断する。
-    prompt = (
-        f"Below is the user's research question followed by the learnings collected so far.\n"
-        f"**Question:** {query}\n\n"
-        "### Current Learnings\n"
-        + "\n".join(f"- {l}" for l in learnings) + "\n\n"
-        "### Task\n"
-        "1. Critically evaluate whether the learnings already provide a complete and well-supported answer to the question.\n"
-        "2. Examine the coverage from multiple angles (e.g., factual accuracy, depth, timeliness, opposing viewpoints, remaining unknowns).\n"
-        "3. Decide if additional research is required.\n\n"
-        "### Response format\n"
-        "Return **exactly one word** (case-insensitive):\n"
-        "- `yes`  → Follow-up research is still needed.\n"
-        "- `no`   → The learnings are sufficient; no further research is required."
-    )
+    # 固定の指示が先頭、質問と知見は末尾
+    prompt = _JUDGE_INSTRUCTIONS + f"**Question:** {query}\n\n### Current Learnings\n" + "\n".join(f"- {l}" for l in learnings)
 
 
     # structured output を Pydantic モデルで指定
-    resp = client.responses.parse(
-        model=LLM_MODEL,
-        reasoning={"effort": "medium"},
-        input=[
+    parsed = await _parse_response(
+        MODELS["judge"],
+        LLMJudgement,
+        [
             {"role": "system", "content": system_prompt()},
             {"role": "user",   "content": prompt},
         ],
-        text_format=LLMJudgement
+        **_reasoning(MODELS["judge"]),
     )
-    
-    parsed = resp.output_parsed
     return parsed.followup_required
 
 
@@ -538,7 +978,7 @@ async def followup_research(
     query: str,
     learnings: Optional[List[str]] = None,
     visited_urls: Optional[List[str]] = None,
-    on_progress: Optional[Callable[[ResearchProgress], None]] = None,
+    on_progress: Optional[Callable[[ResearchProgress, Tuple[str, ...]], None]] = None,
 ) -> ResearchResult:
     """
     フォローアップリサーチを実行し、追加の知見と訪問したURLを返す。
@@ -572,23 +1012,58 @@ async def followup_research(
 
 # CLIエントリーポイント
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Deep Research CLI")
+    parser.add_argument("--query", help="調査テーマ（省略時は対話入力）")
+    parser.add_argument("--breadth", type=int, help="探索幅（推奨 2-10、既定 4）")
+    parser.add_argument("--depth", type=int, help="探索の深さ（推奨 1-5、既定 2）")
+    parser.add_argument("--mode", choices=["report", "answer"], help="出力形式（既定 report）")
+    args = parser.parse_args()
+
+    async def _ask(prompt: str) -> str:
+        # input() はスレッドで待ち、その間もループ上のウォームアップを進める
+        return await asyncio.to_thread(input, prompt)
+
     async def main():
-        initial_query = input("What would you like to research? ")
-        breadth = int(input("Enter research breadth (recommended 2-10, default 4): ") or 4)
-        depth = int(input("Enter research depth (recommended 1-5, default 2): ") or 2)
-        report_flag = input("Generate long report or specific answer? (report/answer, default report): ").lower()
-        is_report = report_flag != "answer"
+        # 入力を待つ間に OpenAI への接続（DNS・TLS）を済ませておく
+        # （models.list() はコルーチンではなく AsyncPaginator を返すので、コルーチンで包んでタスクにする）
+        async def _warmup() -> None:
+            try:
+                await client.models.list()
+            except Exception as e:  # ウォームアップの失敗は本処理で改めて扱う
+                logger.warning("OpenAI warmup failed: %s", e)
+
+        warmup = asyncio.create_task(_warmup())
+
+        initial_query = args.query or await _ask("What would you like to research? ")
+        breadth = args.breadth or int(await _ask("Enter research breadth (recommended 2-10, default 4): ") or 4)
+        depth = args.depth or int(await _ask("Enter research depth (recommended 1-5, default 2): ") or 2)
+        mode = args.mode or (await _ask("Generate long report or specific answer? (report/answer, default report): ")).lower()
+        is_report = mode != "answer"
+
+        await warmup
 
         result = await deep_research(
             initial_query, breadth=breadth, depth=depth,
-            on_progress=lambda p: print(f"{p.completed_queries}/{p.total_queries} done, depth {p.current_depth}")
+            on_progress=lambda p, _: print(f"{p.completed_queries}/{p.total_queries} done, depth {p.current_depth}")
         )
 
         if is_report:
-            report = await write_final_report(initial_query, result.learnings, result.visited_urls)
-            print("\n=== FINAL REPORT ===\n", report)
+            print("\n=== FINAL REPORT ===\n")
+            async for delta in write_final_report_stream(initial_query, result.learnings, result.visited_urls):
+                print(delta, end="", flush=True)
+            print()
         else:
             answer = await write_final_answer(initial_query, result.learnings)
             print("\n=== FINAL ANSWER ===\n", answer)
 
-    asyncio.run(main())
\ No newline at end of file
+    # uvloop があれば高速なイベントループを使う（Windows など未インストールなら標準の asyncio）
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+
+    asyncio.run(main())
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import functools
+import logging
+from typing import Any, Awaitable, Callable, Optional, Type, TypeVar
+
+from pydantic import BaseModel
+
+logger = logging.getLogger("app")
+
+# 保存先（未指定・空文字ならキャッシュしない）と有効期限（秒、0 以下でキャッシュ無効）
+# 同じ入力に過去の応答を返すため、明示的に指定したときだけ有効にする
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(24 * 60 * 60)))
+
+# 意味的キャッシュ：埋め込みのコサイン類似度がこの値以上なら同じ入力とみなす（0 で無効）
+LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0"))
+# 埋め込みに渡す最大文字数（埋め込みモデルの入力上限を超えないように切り詰める）
+SEMANTIC_TEXT_LIMIT = 6000
+
+T = TypeVar("T", bound=BaseModel)
+
+
+# ─────────── SQLite ストア ───────────
+class LLMCache:
+    """構造化出力（Pydantic モデルの JSON）をキーごとに保存する SQLite キャッシュ"""
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # イベントループのスレッドと CLI の両方から使えるよう、スレッド間で共有する
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, model TEXT, schema TEXT, json_blob TEXT, ts REAL)"
+        )
+        self._conn.execute("DELETE FROM llm_cache WHERE ts < ?", (time.time() - ttl,))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT json_blob FROM llm_cache WHERE key = ? AND ts >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, model: str, schema: str, json_blob: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, schema, json_blob, ts) VALUES (?, ?, ?, ?, ?)",
+                (key, model, schema, json_blob, time.time()),
+            )
+
+
+# ─────────── 意味的キャッシュ（埋め込みの近傍検索） ───────────
+class SemanticIndex:
+    """正規化した埋め込みベクトルと構造化出力を保存し、最も近いものを返す
+
+    ベクトルは SQLite に保存し、検索は (モデル, スキーマ) ごとにメモリ上の行列との内積で行う。
+    """
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock, ttl: float):
+        import numpy as np
+
+        self._np = np
+        self._conn = conn
+        self._lock = lock
+        self.ttl = ttl
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "id INTEGER PRIMARY KEY, model TEXT, schema TEXT, vector BLOB, json_blob TEXT, ts REAL)"
+        )
+        self._conn.execute("DELETE FROM semantic_cache WHERE ts < ?", (time.time() - ttl,))
+        # (model, schema) -> (ベクトル行列, JSON のリスト)
+        self._buckets: dict[tuple[str, str], tuple[Any, list[str]]] = {}
+        rows = self._conn.execute("SELECT model, schema, vector, json_blob FROM semantic_cache ORDER BY id").fetchall()
+        for model, schema, vector, json_blob in rows:
+            self._append((model, schema), np.frombuffer(vector, dtype=np.float32), json_blob)
+
+    def _append(self, bucket: tuple[str, str], vec: Any, json_blob: str) -> None:
+        matrix, blobs = self._buckets.get(bucket, (None, []))
+        row = vec.reshape(1, -1)
+        matrix = row if matrix is None else self._np.vstack((matrix, row))
+        self._buckets[bucket] = (matrix, blobs + [json_blob])
+
+    def normalize(self, embedding: list[float]) -> Any:
+        vec = self._np.asarray(embedding, dtype=self._np.float32)
+        norm = float(self._np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    def lookup(self, model: str, schema: str, vec: Any, threshold: float) -> Optional[str]:
+        with self._lock:
+            matrix, blobs = self._buckets.get((model, schema), (None, []))
+        if matrix is None:
+            return None
+        scores = matrix @ vec
+        best = int(scores.argmax())
+        return blobs[best] if float(scores[best]) >= threshold else None
+
+    def add(self, model: str, schema: str, vec: Any, json_blob: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO semantic_cache (model, schema, vector, json_blob, ts) VALUES (?, ?, ?, ?, ?)",
+                (model, schema, vec.tobytes(), json_blob, time.time()),
+            )
+            self._append((model, schema), vec, json_blob)
+
+
+@functools.lru_cache(maxsize=1)
+def get_semantic_index() -> Optional[SemanticIndex]:
+    """意味的キャッシュを返す（閾値が 0 以下、または通常のキャッシュが無効なら None）"""
+    cache = get_cache()
+    if cache is None or LLM_SEMANTIC_CACHE_THRESHOLD <= 0:
+        return None
+    try:
+        return SemanticIndex(cache._conn, cache._lock, cache.ttl)
+    except ImportError as e:
+        logger.warning("LLM semantic cache disabled: numpy is required (pip install numpy): %s", e)
+        return None
+    except sqlite3.Error as e:
+        logger.warning("LLM semantic cache disabled: %s", e)
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def get_cache() -> Optional[LLMCache]:
+    """設定に応じたキャッシュを返す（無効、または開けない場合は None）"""
+    if not LLM_CACHE_PATH or LLM_CACHE_TTL <= 0:
+        return None
+    try:
+        return LLMCache(LLM_CACHE_PATH, LLM_CACHE_TTL)
+    except sqlite3.Error as e:
+        logger.warning("LLM cache disabled: %s", e)
+        return None
+
+
+def make_key(model: str, schema_name: str, messages: Any, **params: Any) -> str:
+    """モデル名・スキーマ名・入力メッセージ・その他パラメータから決まるキーを作る"""
+    payload = json.dumps(
+        [model, schema_name, messages, params], ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ─────────── デコレータ ───────────
+def llm_cached(
+    fn: Callable[..., Awaitable[T]],
+) -> Callable[..., Awaitable[T]]:
+    """`fn(model, text_format, messages, **params)` の結果をキャッシュする
+
+    同じ入力なら API を呼ばずに、保存済みの JSON を `text_format` で検証して返す。
+    """
+
+    @functools.wraps(fn)
+    async def _wrapped(model: str, text_format: Type[T], messages: Any, **params: Any) -> T:
+        cache = get_cache()
+        if cache is None:
+            return await fn(model, text_format, messages, **params)
+
+        key = make_key(model, text_format.__name__, messages, **params)
+        blob = cache.get(key)
+        if blob is not None:
+            return text_format.model_validate_json(blob)
+
+        parsed = await fn(model, text_format, messages, **params)
+        cache.set(key, model, text_format.__name__, parsed.model_dump_json())
+        return parsed
+
+    return _wrapped
+
+
+def semantic_cached(
+    embed: Callable[[str], Awaitable[list[float]]],
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """`semantic_text=...` 付きで呼ばれたときだけ、意味的に近い過去の結果を返すデコレータ
+
+    `embed` は文字列を埋め込みベクトルに変換するコルーチン。埋め込みに失敗した場合は
+    キャッシュを使わずにそのまま `fn` を呼ぶ。
+    """
+
+    def _decorator(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(fn)
+        async def _wrapped(
+            model: str, text_format: Type[T], messages: Any, *, semantic_text: Optional[str] = None, **params: Any
+        ) -> T:
+            index = get_semantic_index() if semantic_text else None
+            if index is None:
+                return await fn(model, text_format, messages, **params)
+
+            try:
+                vec = index.normalize(await embed(semantic_text[:SEMANTIC_TEXT_LIMIT]))
+            except Exception as e:
+                logger.warning("Embedding failed, skipping semantic cache: %s", e)
+                return await fn(model, text_format, messages, **params)
+
+            blob = index.lookup(model, text_format.__name__, vec, LLM_SEMANTIC_CACHE_THRESHOLD)
+            if blob is not None:
+                return text_format.model_validate_json(blob)
+
+            parsed = await fn(model, text_format, messages, **params)
+            index.add(model, text_format.__name__, vec, parsed.model_dump_json())
+            return parsed
+
+        return _wrapped
+
+    return _decorator
@@ -0,0 +1,37 @@
+import functools
+import importlib.util
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# h2 パッケージがあれば HTTP/2 で多重化する（無ければ HTTP/1.1 の keep-alive のみ）
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 1 リクエストあたりのタイムアウト（秒）。長いレポート生成でも切れないよう長めにとる
+OPENAI_TIMEOUT = 120.0
+
+# 再帰調査の並列数（幅×深さ）に対して十分な接続数を確保しつつ、上限を設けて暴走を防ぐ
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """API キーごとに 1 つの AsyncOpenAI を返す
+
+    LLM 呼び出し（deep_research）と OpenAI の Web 検索（crawler_factory）で同じ接続プールを
+    使い回し、呼び出しごとの TCP/TLS ハンドシェイクを避ける。
+    タイムアウトは AsyncOpenAI に数値で渡す（リクエストごとのタイムアウトとして SDK が扱う）。
+    """
+    return AsyncOpenAI(
+        api_key=api_key,
+        timeout=OPENAI_TIMEOUT,
+        http_client=DefaultAsyncHttpxClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        ),
+    )